@@ -8,19 +8,44 @@ from __future__ import print_function
 
 import sys
 import json
-import requests
+import time
 from collections import OrderedDict
 
+# Use the faster orjson to decode API responses if available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # In case of Python 2
 if sys.version_info.major == 2:
     input = raw_input  # noqa
 
+# time.monotonic is not available in Python 2
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+def _requests():
+    '''Import requests on first use, it is slow to import.'''
+    import requests
+    return requests
+
+
+def _to_bool(value):
+    '''Convert a '0'/'1' status value to bool.'''
+    return bool(int(value))
+
 
 class Interface(object):
     '''Interface class to get variables and call functions on
        the SUXESs lab microcontroller.
        Uses the Particle API: docs.particle.io
     '''
+    # Converters for the values in the status string, default is float
+    _STATUS_CONVERTERS = {'power': _to_bool,
+                          'ups': _to_bool,
+                          'armed': _to_bool}
+
     def __init__(self, token_file='sentinel_config.json'):
         # Setup the API keys
         with open(token_file) as f:
@@ -31,6 +56,10 @@ class Interface(object):
 
         self.url = 'https://api.particle.io/v1/devices/%s/%s'
 
+        # HTTP session, created on first request
+        self._session = None
+        self.max_retries = 3
+
         # The available variables and functions
         self.exposed_variables = ['power', 'upspower', 'pressure', 'status']
         self.exposed_functions = {'alarm': ['arm', 'disarm'],
@@ -39,16 +68,74 @@ class Interface(object):
                                                 '2700', '2800'],
                                   'test': ['']}
 
+        # Full API urls for all variables and functions
+        self._urls = {name: self.url % (self.device_id, name)
+                      for name in (list(self.exposed_variables) +
+                                   list(self.exposed_functions))}
+
+        # Variables that are also part of the status string,
+        # mapped to their key in the parsed status
+        self._status_keys = {'power': 'power',
+                             'upspower': 'ups',
+                             'pressure': 'pressure'}
+
+        # Post-processing of variables, e.g. parse the status string
+        self._post = {'status': self.parse_status}
+
+        # Cache of variable reads: {variable: (timestamp, result)}
+        self._cache = {}
+        self._ttl = 2.0
+        # Cached variables that are changed by calling a function
+        self._invalidates = {'alarm': ['status'],
+                             'threshold': ['status']}
+        # Functions that are safe to call again when a request fails,
+        # e.g. 'test' publishes an event on every call
+        self._idempotent = ['alarm', 'led', 'threshold']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def session(self):
+        '''HTTP session that keeps connections to the API alive.
+           requests is only imported when the session is first used.
+        '''
+        if self._session is None:
+            requests = _requests()
+            from requests.adapters import HTTPAdapter
+            self._session = requests.Session()
+            self._session.mount('https://', HTTPAdapter(pool_connections=2,
+                                                        pool_maxsize=4))
+            self._session.headers['Authorization'] = \
+                'Bearer %s' % self.access_token
+        return self._session
+
+    def close(self):
+        '''Close the connections to the API.'''
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
     def __call__(self, name, argument=None):
         '''Communicate with the microcontroller. Call with one argument
            to get variable "name", or with two arguments to call function
            "name(argument)".'''
         if argument is None:
             # Get a variable
-            if name == 'status':
-                # Parse the status string into a dictionary
-                return self.parse_status(self.get_variable(name))
-            return self.get_variable(name)
+            if name in self._status_keys:
+                # Served from the status string, one request for all
+                status = self.get_variable('status')
+                if status == -1:
+                    return -1
+                return self.parse_status(status)[self._status_keys[name]]
+            value = self.get_variable(name)
+            if value == -1:
+                return -1
+            post = self._post.get(name)
+            return post(value) if post else value
         else:
             # Call a function
             return self.call_function(name, argument)
@@ -56,42 +143,105 @@ class Interface(object):
     def get_variable(self, variable):
         '''Get 'variable', only variables in
            self.exposed_variables are allowed.
+           Results are cached for self._ttl seconds, -1 is returned
+           if the API request fails or the value cannot be parsed.
         '''
-        assert variable in self.exposed_variables
-        full_url = self.url % (self.device_id, variable)
-        r = requests.get(full_url, params={'access_token': self.access_token})
-        if 'result' not in r.json().keys():
-            print("Error: no result from API, possible timeout, try again.")
+        if variable not in self.exposed_variables:
+            raise ValueError("Unknown variable: %r" % variable)
+        if variable in self._cache:
+            ts, result = self._cache[variable]
+            if monotonic() - ts < self._ttl:
+                return result
+        result = self._get_variable_uncached(variable)
+        if result == -1:
             return -1
-        return r.json()['result']
+        if variable in self._post:
+            # Do not cache or use values that cannot be parsed,
+            # e.g. "setup" as status before the device is running
+            try:
+                self._post[variable](result)
+            except ValueError:
+                print("Error: could not parse %s %r, try again."
+                      % (variable, result))
+                return -1
+        self._cache[variable] = (monotonic(), result)
+        return result
+
+    def _get_variable_uncached(self, variable):
+        '''Get 'variable' from the API, bypassing the cache.'''
+        full_url = self._urls[variable]
+        return self._request('get', full_url, 'result')
 
     def call_function(self, function, argument):
         '''Call 'function(argument)', only the specific
            combinations of function and argument in
            exposed_functions are allowed.
         '''
-        assert type(argument) == str
-        assert function in self.exposed_functions.keys()
-        assert argument in self.exposed_functions[function]
-        full_url = self.url % (self.device_id, function)
-        r = requests.post(full_url, data={'access_token': self.access_token,
-                                          function: argument})
-        if 'return_value' not in r.json().keys():
-            print("Error: no result from API, possible timeout, try again.")
-            return -1
-        return r.json()['return_value']
+        if not isinstance(argument, str):
+            raise ValueError("Argument must be a string: %r" % argument)
+        if function not in self.exposed_functions:
+            raise ValueError("Unknown function: %r" % function)
+        if argument not in self.exposed_functions[function]:
+            raise ValueError("Invalid argument for %s: %r"
+                             % (function, argument))
+        full_url = self._urls[function]
+        for variable in self._invalidates.get(function, []):
+            self._cache.pop(variable, None)
+        return self._request('post', full_url, 'return_value',
+                             retry=function in self._idempotent,
+                             data={function: argument})
+
+    def _request(self, method, url, key, retry=True, **kw):
+        '''Do an API request and return 'key' from the JSON response.
+           Timeouts, connection errors, server errors, device timeouts
+           (408), rate limiting (429) and responses without 'key'
+           are retried up to self.max_retries times (so at most
+           self.max_retries + 1 attempts) with exponential backoff,
+           -1 is returned on final failure.
+           With retry=False the request is done only once.
+        '''
+        requests = _requests()
+        attempts = self.max_retries + 1 if retry else 1
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(0.25 * 2**(attempt - 1))
+            try:
+                r = self.session.request(method, url, timeout=5, **kw)
+                if r.status_code >= 500 or r.status_code in (408, 429):
+                    # Server error, device timeout or rate limited
+                    continue
+                if r.status_code >= 400:
+                    # Client errors will not go away by retrying, do not
+                    # print the exception, its url may hold the token
+                    print("Error: API returned %d %s."
+                          % (r.status_code, r.reason))
+                    return -1
+            except (requests.Timeout, requests.ConnectionError):
+                continue
+            try:
+                if orjson is not None:
+                    payload = orjson.loads(r.content)
+                else:
+                    payload = r.json()
+            except ValueError:
+                continue
+            if isinstance(payload, dict):
+                result = payload.get(key)
+                if result is not None:
+                    return result
+        print("Error: no result from API after %d attempt(s), "
+              "possible timeout, try again." % attempts)
+        return -1
 
-    @staticmethod
-    def parse_status(status):
+    @classmethod
+    def parse_status(cls, status):
         '''Parse the status string into a Python dict.'''
-        assert status is not -1
+        if status == -1:
+            raise RuntimeError("No status received from API.")
         d = OrderedDict()
         for pair in status.split(','):
-            k, v = pair.split(':')
-            if k in ['power', 'ups', 'armed']:
-                d[k] = bool(int(v))
-            else:
-                d[k] = float(v)
+            k, _, v = pair.partition(':')
+            d[k] = cls._STATUS_CONVERTERS.get(k, float)(v)
         return d
 
 
@@ -128,6 +278,21 @@ class Menu(object):
     def __init__(self, interface):
         self.interface = interface
 
+        # Styled menu texts, built once
+        self._menu_text = self.styled(
+            ["%d) %s" % (idx, option)
+             for idx, option in enumerate(self.menu_options)], 'head')
+        self._alarm_text = self.styled(["0) Disable the alarms.",
+                                        "1) Enable the alarms."], 'head')
+        self._threshold_text = self.styled(
+            ["Set pressure alarm threshold to:"] +
+            ["%d) %s mbar" % (idx, val) for idx, val in
+             enumerate(self.interface.exposed_functions['threshold'])],
+            'head')
+        self._threshold_indices = frozenset(
+            str(i) for i in
+            range(len(self.interface.exposed_functions['threshold'])))
+
     def run(self):
         self.cprint("SUXeSs microcontroller interface.", 'bold_head')
         try:
@@ -147,19 +312,25 @@ class Menu(object):
             self.cprint(m, 'ok' if v else 'fail')
 
     def menu(self):
-        for idx, option in enumerate(self.menu_options):
-            self.cprint("%d) %s" % (idx, option), 'head')
+        print(self._menu_text)
         choice = input("Select option: ")
 
         if choice in ['0', '1', '2']:  # power, ups power, pressure
             var_name = self.menu_choices[int(choice)]
             print("Requesting %s values.." % var_name)
-            self.string_print(var_name, self.interface(var_name))
+            value = self.interface(var_name)
+            if value == -1:
+                self.cprint('Could not get value, try again.', 'fail')
+            else:
+                self.string_print(var_name, value)
         elif choice == '3':  # all stats
             print("Requesting values..")
             status = self.interface('status')
-            for k, v in status.items():
-                self.string_print(k, v)
+            if status == -1:
+                self.cprint('Could not get values, try again.', 'fail')
+            else:
+                for k, v in status.items():
+                    self.string_print(k, v)
         elif choice == '4':  # arm/disarm alarms
             self._alarm_submenu()
         elif choice == '5':  # Set pressure alarm threshold
@@ -170,8 +341,7 @@ class Menu(object):
             self.cprint('Wrong option, try again.', 'fail')
 
     def _alarm_submenu(self):
-        self.cprint("0) Disable the alarms.", 'head')
-        self.cprint("1) Enable the alarms.", 'head')
+        print(self._alarm_text)
 
         alarm = input("Select option: ")
         if alarm == '0':
@@ -191,12 +361,10 @@ class Menu(object):
 
     def _threshold_submenu(self):
         options = self.interface.exposed_functions['threshold']
-        self.cprint("Set pressure alarm threshold to:", 'head')
-        for idx, val in enumerate(options):
-            self.cprint("%d) %s mbar" % (idx, val), 'head')
+        print(self._threshold_text)
 
         new_threshold = input("Select option: ")
-        if new_threshold in [str(i) for i in range(len(options))]:
+        if new_threshold in self._threshold_indices:
             new_pressure = options[int(new_threshold)]
             # Attempt to set new threshold, check return value for success
             res = self.interface('threshold', new_pressure)
@@ -212,11 +380,15 @@ class Menu(object):
     def cprint(self, message, style):
         print(self.styles[style] + message + self.styles['end'])
 
+    def styled(self, lines, style):
+        '''Join lines into one string, each line styled as in cprint.'''
+        return '\n'.join(self.styles[style] + line + self.styles['end']
+                         for line in lines)
+
 
 if __name__ == '__main__':
     # When running as script present a simple menu to query the variables
     # enable/disable the alarms and set the pressure threshold.
-    sentinel = Interface()
-
-    menu = Menu(sentinel)
-    menu.run()
+    with Interface() as sentinel:
+        menu = Menu(sentinel)
+        menu.run()